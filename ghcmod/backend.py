@@ -2,12 +2,20 @@
 The ghc-mod backend
 '''
 
-import io
+import concurrent.futures
+import itertools
+import operator
 import os.path
 import pprint
+import queue
 import re
+import subprocess
 import threading
+import time
 import sys
+import traceback
+
+from collections import OrderedDict
 
 import sublime
 
@@ -26,11 +34,31 @@ FILE_LINE_COL_REGEX = r'^(?P<file>\S*):(?P<line>\d+):(?P<col>\d+):\s*((?P<flag>[
 ## The non-capturing version, which stops the match at the next warning/error when spanning across multiple lines.
 NONCAPTURE_FLC_REGEX = r'^\S*:\d+:\d+:\s*(\*|[Ww]arning|\w+):'
 
-GHC_CHECK_REGEX = re.compile(FILE_LINE_COL_REGEX + r'(?P<details>.*$(\n?^(?!' + NONCAPTURE_FLC_REGEX + r')(?:\*?\s+).*$)*)',
+## Horizontal whitespace (i.e., whitespace that can't run onto the next line.)
+HWS_REGEX = r'[^\S\n]'
+
+## The message details are lines that are indented (optionally with a leading '*' bullet), possibly separated by blank
+## lines. '[^\n]*' instead of '.*$' keeps each line a single, non-backtracking run; an indented line can never start the
+## next 'file:line:col:' message, so check does not need a lookahead.
+GHC_CHECK_REGEX = re.compile(FILE_LINE_COL_REGEX + r'(?P<details>[^\n]*(?:\n(?:' + HWS_REGEX + r'*\n)*\*?' + HWS_REGEX +
+                             r'+[^\n]*)*)',
                              re.MULTILINE)
-GHC_LINT_REGEX = re.compile(FILE_LINE_COL_REGEX + r'(?P<msg>.*$)(?P<details>(\n?((?!' + NONCAPTURE_FLC_REGEX + r').*$))+)',
+GHC_LINT_REGEX = re.compile(FILE_LINE_COL_REGEX + r'(?P<msg>[^\n]*)(?P<details>(?:\n(?!' + NONCAPTURE_FLC_REGEX +
+                            r')[^\n]*)*)',
                             re.MULTILINE)
 
+## Fully qualified module names, e.g., 'Data.List'
+DOTTED_NAME_RE = re.compile(r'\w+(?:\.\w+)+')
+
+## 'browse -d' declaration prefix -> symbol constructor. Anything not in here is a function.
+_DECL_CTORS = {'class': symbols.Class,
+               'data': symbols.Data,
+               'newtype': symbols.Newtype,
+               'type': symbols.Type}
+
+## Package database names in a cabal directory, e.g., 'packages-7.10.3.conf'
+_PKGDB_RE = re.compile(r'packages-.*\.conf')
+
 def debug_send():
     return Settings.COMPONENT_DEBUG.all_messages or Settings.COMPONENT_DEBUG.send_messages
 
@@ -67,6 +95,10 @@ class GHCModBackend(Backend.HaskellBackend):
 
         # The project backends, indexed by project name
         self.project_backends = {}
+        # Thread pool used to talk to several projects' ghc-mods concurrently (created on demand)
+        self._io_pool = None
+        # cabal directory -> package databases found there (see ghci_package_db)
+        self._pkgdb_cache = {}
 
     @staticmethod
     def backend_name():
@@ -74,7 +106,7 @@ class GHCModBackend(Backend.HaskellBackend):
 
     @staticmethod
     def is_available(**_kwargs):
-        return Which.which('ghc-mod', ProcHelper.ProcHelper.get_extended_path())
+        return Which.which_from_list('ghc-mod', ProcHelper.ProcHelper.search_path())
 
     def start_backend(self):
         return True
@@ -90,6 +122,10 @@ class GHCModBackend(Backend.HaskellBackend):
         for project in self.project_backends:
             self.project_backends[project].shutdown()
         self.project_backends = {}
+        if self._io_pool is not None:
+            self._io_pool.shutdown(wait=False)
+            self._io_pool = None
+        self._pkgdb_cache = {}
 
     def is_live_backend(self):
         '''ghc-mod is always a live backend.'''
@@ -109,6 +145,9 @@ class GHCModBackend(Backend.HaskellBackend):
         if project not in self.project_backends:
             opt_args = self.get_ghc_opts_args(filename, add_package_db=True, cabal=project_dir)
             self.project_backends[project] = GHCModClient(project, project_dir, opt_args)
+        else:
+            # Warm up a ghc-mod that was shut down for being idle.
+            self.project_backends[project].ensure_running()
 
     def remove_project_file(self, filename):
         pass
@@ -167,18 +206,23 @@ class GHCModBackend(Backend.HaskellBackend):
                sandbox=None, cabal=False, symdb=None, package=None, source=False, standalone=False, **backend_args):
         modsyms = None
 
-        if search_type == 'exact' and re.match(r'\w+(\.\w+)+', lookup):
+        if search_type == 'exact' and DOTTED_NAME_RE.match(lookup):
             backend = self.project_backends.get(project_name)
-            modinfo = backend.command_backend('browse -d -o ' + lookup) if backend is not None else []
-            if Settings.COMPONENT_DEBUG.recv_messages or Settings.COMPONENT_DEBUG.all_messages:
-                print('ghc-mod modules: resp =\n{0}'.format(pprint.pformat(modinfo)))
-
-            impinfo = [symbols.Module(lookup)]
-            moddecls = dict([(decl.name, decl) for decl in [self.parse_syminfo(mdecl, impinfo) for mdecl in modinfo]])
-            if Settings.COMPONENT_DEBUG.recv_messages or Settings.COMPONENT_DEBUG.all_messages:
-                print('ghc-mod modules: moddecls =\n{0}'.format(pprint.pformat(moddecls)))
-
-                modsyms = symbols.Module(lookup, [], [], moddecls, symbols.PackageDb(global_db=True))
+            modsyms = backend.cached_browse(lookup) if backend is not None else None
+            if modsyms is None:
+                modinfo = backend.command_backend('browse -d -o ' + lookup) if backend is not None else []
+                if Settings.COMPONENT_DEBUG.recv_messages or Settings.COMPONENT_DEBUG.all_messages:
+                    print('ghc-mod modules: resp =\n{0}'.format(pprint.pformat(modinfo)))
+
+                # Nothing browsed (unknown module, or no ghc-mod running): no module, and nothing to remember.
+                if modinfo:
+                    location = symbols.InstalledLocation(lookup, symbols.Package(package)) if package else None
+                    modsyms = symbols.Module(lookup, location)
+                    modsyms.exports = [self.parse_syminfo(mdecl, modsyms) for mdecl in modinfo]
+                    if Settings.COMPONENT_DEBUG.recv_messages or Settings.COMPONENT_DEBUG.all_messages:
+                        print('ghc-mod modules: exports =\n{0}'.format(pprint.pformat(modsyms.exports)))
+
+                    backend.cache_browse(lookup, modsyms)
 
         return self.dispatch_callbacks([modsyms] if modsyms else [], None, **backend_args)
 
@@ -212,14 +256,19 @@ class GHCModBackend(Backend.HaskellBackend):
 
             return symbols.Package(pkg_name, pkg_ver)
 
+        pred = self.lookup_predicate(lookup, search_type)
         backend = self.project_backends.get(project_name)
-        modules = backend.command_backend('list -d') if backend is not None else ([], [])
+        modules = backend.command_backend('list -d') if backend is not None else []
         if Settings.COMPONENT_DEBUG.recv_messages or Settings.COMPONENT_DEBUG.all_messages:
             print('ghc-mod scope_modules: resp =\n{0}'.format(modules))
 
-        filtered_mods = [symbols.Module(mod[1], [], [], {},
-                                        symbols.InstalledLocation(make_pkg(mod[0]), symbols.PackageDb(global_db=True)))
-                         for mod in (m.split() for m in modules if self.lookup_match(m[1], lookup, search_type))]
+        # Each line is '<package> <module name>'. Split each line once and filter on the module name.
+        filtered_mods = []
+        for line in modules:
+            parts = line.split()
+            if len(parts) < 2 or not pred(parts[1]):
+                continue
+            filtered_mods.append(symbols.Module(parts[1], symbols.InstalledLocation(parts[1], make_pkg(parts[0]))))
 
         if Settings.COMPONENT_DEBUG.recv_messages or Settings.COMPONENT_DEBUG.all_messages:
             print('ghc-mod scope_modules: filtered_mods\n{0}'.format(pprint.pformat(filtered_mods)))
@@ -296,14 +345,17 @@ class GHCModBackend(Backend.HaskellBackend):
     def unresolveds(self, files, **backend_args):
         return self.dispatch_callbacks([], None, **backend_args)
 
+    ## ghc-mod command verbs for lint and check. translate_regex_output appends the file name.
+    LINT_CMD = 'lint'
+    CHECK_CMD = 'check'
+
     def lint(self, files=None, contents=None, hlint=None, wait_complete=False, **backend_args):
-        lint_cmd = ' '.join(['lint'] + (hlint or []))
+        lint_cmd = self.LINT_CMD + ' ' + ' '.join(hlint) if hlint else self.LINT_CMD
         lint_output = self.translate_regex_output(lint_cmd, files, contents, GHC_LINT_REGEX, self.translate_lint)
         return self.dispatch_callbacks(lint_output, None, **backend_args)
 
     def check(self, files=None, contents=None, ghc=None, wait_complete=False, **backend_args):
-        check_cmd = 'check '
-        check_output = self.translate_regex_output(check_cmd, files, contents, GHC_CHECK_REGEX, self.translate_check)
+        check_output = self.translate_regex_output(self.CHECK_CMD, files, contents, GHC_CHECK_REGEX, self.translate_check)
         return self.dispatch_callbacks(check_output, None, **backend_args)
 
     def check_lint(self, files=None, contents=None, ghc=None, hlint=None, wait_complete=False, **backend_args):
@@ -416,16 +468,18 @@ class GHCModBackend(Backend.HaskellBackend):
     def get_backend(self, filename):
         backend_info = self.file_to_project.get(filename)
         if backend_info is not None:
-            backend = self.project_backends.get(backend_info[0])
-            if backend is not None:
-                return backend
-            else:
-                Logging.log('{0}: {1} does not have an active ghc-mod!'.format(type(self).__name__, backend_info[0]))
-        else:
-            Logging.log('{0}: {1} does not map to a project!'.format(type(self).__name__, filename))
+            return self.get_project_backend(backend_info[0])
 
+        Logging.log('{0}: {1} does not map to a project!'.format(type(self).__name__, filename))
         return None
 
+    def get_project_backend(self, project):
+        backend = self.project_backends.get(project)
+        if backend is None:
+            Logging.log('{0}: {1} does not have an active ghc-mod!'.format(type(self).__name__, project))
+
+        return backend
+
     def command_backend(self, filename, cmd, do_map=False, file=None, contents=None):
         backend = self.get_backend(filename)
         if backend is not None:
@@ -433,33 +487,89 @@ class GHCModBackend(Backend.HaskellBackend):
 
         return []
 
-    def translate_regex_output(self, cmd, files, contents, regex, xlat_func):
-        retval = []
+    def project_batches(self, files):
+        '''Group files by the project (and hence ghc-mod client) to which they belong, in the order in which the projects
+        are first encountered. Returns a list of (backend, project_dir, files) tuples. Files that do not map to an active
+        ghc-mod are dropped, with the same log messages as get_backend().
+
+        Each file's project is looked up once, and each project's ghc-mod client once per call.
+        '''
+        file_to_project = self.file_to_project.get
+        batches = OrderedDict()
         for file in files:
-            project_dir = self.get_project_dir(file)
-            map_file = contents is not None and file in contents
-            fcontent = contents[file] if map_file else None
+            backend_info = file_to_project(file)
+            if backend_info is None:
+                Logging.log('{0}: {1} does not map to a project!'.format(type(self).__name__, file))
+                continue
+
+            project, project_dir = backend_info
+            batch = batches.get(project)
+            if batch is None:
+                backend = self.get_project_backend(project)
+                # Remember projects without a ghc-mod, too, so that they are only looked up (and logged) once.
+                batch = batches[project] = (backend, project_dir, [])
+            if batch[0] is not None:
+                batch[2].append(file)
+
+        return [batch for batch in batches.values() if batch[0] is not None]
 
-            resp = self.command_backend(file, cmd + ' ' + file, map_file, file, fcontent)
+    ## Upper bound on the number of projects' ghc-mods queried concurrently.
+    IO_POOL_WORKERS = 4
+
+    def translate_regex_output(self, cmd, files, contents, regex, xlat_func):
+        def translate_batch(backend, project_dir, batch):
+            mapped = dict([(file, contents[file]) for file in batch if file in contents]) if contents else {}
+            batch_output = []
+            # Every file in the batch shares project_dir, so the resolved message file names can be shared, too.
+            resolve_cache = {}
 
-            if Settings.COMPONENT_DEBUG.recv_messages or Settings.COMPONENT_DEBUG.all_messages:
-                print('ghc-mod: {0}: map_file {1}, resp =\n{2}'.format(cmd, map_file, pprint.pformat(resp)))
+            def translate_reply(index, resp):
+                # Called as each reply arrives, while ghc-mod is busy with the next command in the batch.
+                file = batch[index]
+                if Settings.COMPONENT_DEBUG.recv_messages or Settings.COMPONENT_DEBUG.all_messages:
+                    print('ghc-mod: {0}: map_file {1}, resp =\n{2}'.format(cmd, file in mapped, pprint.pformat(resp)))
 
-            retval.extend([xlat_func(project_dir, m) for m in regex.finditer('\n'.join(resp))])
+                batch_output.extend([xlat_func(project_dir, m, resolve_cache) for m in regex.finditer(resp)])
+
+            backend.command_batch(['{0} {1}'.format(cmd, file) for file in batch], mapped, joined=True,
+                                  on_reply=translate_reply)
+            return batch_output
+
+        retval = []
+        batches = self.project_batches(files)
+        if len(batches) > 1:
+            # Each project has its own ghc-mod process and pipes, so there's no reason to wait on one before the next.
+            if self._io_pool is None:
+                self._io_pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.IO_POOL_WORKERS)
+            pending = [self._io_pool.submit(translate_batch, *batch) for batch in batches]
+            for future in concurrent.futures.as_completed(pending):
+                retval.extend(future.result())
+        else:
+            for batch in batches:
+                retval.extend(translate_batch(*batch))
 
         if Settings.COMPONENT_DEBUG.recv_messages or Settings.COMPONENT_DEBUG.all_messages:
             print('ghc-mod: {0}:\n{1}'.format(cmd, pprint.pformat(retval)))
 
         return retval
 
-    def translate_check(self, project_dir, errmsg):
+    def resolve_filename(self, project_dir, filename, resolve_cache):
+        '''Absolute path for a file name in ghc-mod's output. `resolve_cache` remembers the result for each file name so
+        that a flood of messages about the same file doesn't redo the path normalization.
+        '''
+        abs_filename = resolve_cache.get(filename)
+        if abs_filename is None:
+            # HACK ALERT: If the file name is not absolute, that means ghc-mod reported it relative to the
+            # project directory. So we have to reconstitute the full file name expected by SublimeHaskell.
+            abs_filename = filename if os.path.isabs(filename) else os.path.normpath(os.path.join(project_dir, filename))
+            resolve_cache[filename] = abs_filename
+
+        return abs_filename
+
+    def translate_check(self, project_dir, errmsg, resolve_cache):
         line, column = int(errmsg.group('line')), int(errmsg.group('col'))
 
-        # HACK ALERT: If the file name is not absolute, that means ghc-mod reported it relative to the
-        # project directory. So we have to reconstitute the full file name expected by SublimeHaskell.
-        filename = errmsg.group('file')
-        if not os.path.isabs(filename):
-            filename = os.path.normpath(os.path.join(project_dir, filename))
+        filename = self.resolve_filename(project_dir, errmsg.group('file'), resolve_cache)
 
         flag = errmsg.group('flag')
         level_type = 'error' if flag is None or not flag.lower().startswith('warning') else 'warning'
@@ -472,14 +582,10 @@ class GHCModBackend(Backend.HaskellBackend):
                            'project': None}
                }
 
-    def translate_lint(self, project_dir, errmsg):
+    def translate_lint(self, project_dir, errmsg, resolve_cache):
         line, column = int(errmsg.group('line')), int(errmsg.group('col'))
 
-        # HACK ALERT: If the file name is not absolute, that means ghc-mod reported it relative to the
-        # project directory. So we have to reconstitute the full file name expected by SublimeHaskell.
-        filename = errmsg.group('file')
-        if not os.path.isabs(filename):
-            filename = os.path.normpath(os.path.join(project_dir, filename))
+        filename = self.resolve_filename(project_dir, errmsg.group('file'), resolve_cache)
 
         # ghc-mod does not return the start and end of the region, so we can't craft a corrector.
         return {'level': 'hint',
@@ -491,14 +597,22 @@ class GHCModBackend(Backend.HaskellBackend):
                            'project': None}
                }
 
-    def lookup_match(self, elt, lookup, search_type):
-        ## Note: The tests are ordered from most to least likely. In fact, I'm not sure if infix or regex is actually
-        ## used in the code.
-        return (search_type == 'exact' and elt == lookup) or \
-               (search_type == 'prefix' and elt.startswith(lookup)) or \
-               (search_type == 'suffix' and elt.endswith(lookup)) or \
-               (search_type == 'infix' and lookup in elt) or \
-               (search_type == 'regex' and re.search(lookup, elt))
+    def lookup_predicate(self, lookup, search_type):
+        '''Return a one-argument predicate that tests a name against `lookup` according to `search_type`. Build it once
+        and apply it to each candidate; the 'regex' pattern is compiled only once.
+        '''
+        if search_type == 'exact':
+            return lookup.__eq__
+        elif search_type == 'prefix':
+            return operator.methodcaller('startswith', lookup)
+        elif search_type == 'suffix':
+            return operator.methodcaller('endswith', lookup)
+        elif search_type == 'infix':
+            return lookup.__contains__
+        elif search_type == 'regex':
+            return re.compile(lookup).search
+
+        return lambda _elt: False
 
     def split_context_args(self, name, signature):
         def trim_name(args):
@@ -508,60 +622,67 @@ class GHCModBackend(Backend.HaskellBackend):
         if len(sig) == 1:
             return (None, trim_name(sig[0].split()))
 
-        return (sig[0], trim_name(sig[1].split()))
+        # The context as a list of constraints, e.g., '(Eq a, Show a)' -> ['Eq a', 'Show a'].
+        context = [constraint.strip() for constraint in sig[0].strip('()').split(',')]
+        return (context, trim_name(sig[1].split()))
 
     def get_name_decl(self, signature):
         sig = signature.split(' :: ')
         return (sig[0], sig[1] if len(sig) > 1 else '')
 
     def ghci_package_db(self, cabal):
+        '''Package databases in the `cabal` directory, as a list of paths (None if there aren't any.) Results are cached
+        per directory until the backend is stopped.
+        '''
         if cabal is not None and cabal != 'cabal':
-            package_conf = [pkg for pkg in os.listdir(cabal) if re.match(r'packages-(.*)\.conf', pkg)]
-            if package_conf:
-                return os.path.join(cabal, package_conf)
+            if cabal in self._pkgdb_cache:
+                return self._pkgdb_cache[cabal]
+
+            # os.scandir() yields entries lazily; Sublime Text 3's Python 3.3 predates it, though.
+            entries = (entry.name for entry in os.scandir(cabal)) if hasattr(os, 'scandir') else os.listdir(cabal)
+            package_conf = [os.path.join(cabal, pkg) for pkg in entries if _PKGDB_RE.match(pkg)] or None
+            self._pkgdb_cache[cabal] = package_conf
+            return package_conf
 
         return None
 
 
     def get_ghc_opts(self, filename, add_package_db, cabal):
         """
-        Gets ghc_opts, used in several tools, as list with extra '-package-db' option and '-i' option if filename passed
+        Generates ghc_opts, used in several tools, with extra '-package-db' option and '-i' option if filename passed.
+        Note: this is a generator; the user's ghc_opts setting is never modified.
         """
-        ghc_opts = Settings.PLUGIN.ghc_opts or []
+        for opt in Settings.PLUGIN.ghc_opts or []:
+            yield opt
+
         if add_package_db:
-            package_db = self.ghci_package_db(cabal=cabal)
-            for pkgdb in package_db or []:
-                ghc_opts.append('-package-db {0}'.format(pkgdb))
+            for pkgdb in self.ghci_package_db(cabal=cabal) or []:
+                yield '-package-db {0}'.format(pkgdb)
 
         if filename:
-            ghc_opts.append('-i {0}'.format(ProcHelper.get_source_dir(filename)))
-
-        return ghc_opts
+            yield '-i {0}'.format(ProcHelper.get_source_dir(filename))
 
 
     def get_ghc_opts_args(self, filename, add_package_db, cabal):
         """
         Same as ghc_opts, but uses '-g' option for each option
         """
-        opts = self.get_ghc_opts(filename, add_package_db, cabal)
-        args = []
-        for opt in opts:
-            args.extend(['-g', opt])
-        return args
+        return list(itertools.chain.from_iterable(('-g', opt) for opt in self.get_ghc_opts(filename, add_package_db, cabal)))
 
     def collect_completions(self, backend, modinfo, lookup):
         if Settings.COMPONENT_DEBUG.completions:
             print('ghc-mod collect_completions for {0}'.format(modinfo))
 
         modname, is_qualified, qualname = modinfo
-        mod_imported = [symbols.Import(modname, is_qualified, qualname)]
+        module = symbols.Module(modname)
+        qualifier = (qualname or modname) if is_qualified else None
         syms = backend.command_backend('browse -d -o ' + modname) if backend is not None else []
         Logging.log('ghc-mod collect_completions: syms {0}'.format(syms), Logging.LOG_DEBUG)
-        return [self.parse_syminfo(sym, mod_imported) for sym in syms if sym.startswith(lookup)]
+        return [self.parse_syminfo(sym, module, qualifier) for sym in syms if sym.startswith(lookup)]
 
 
-    def parse_syminfo(self, syminfo, mod_imported):
-        '''Convert a ghc-mod 'browse' result into the expected symbol types
+    def parse_syminfo(self, syminfo, module, qualifier=None):
+        '''Convert a ghc-mod 'browse' result into the expected symbol types, defined in `module`.
         '''
         name, declinfo = self.get_name_decl(syminfo)
 
@@ -569,24 +690,14 @@ class GHCModBackend(Backend.HaskellBackend):
         if name[0] == '(' and name[-1] == ')' and len(name) > 2:
             name = name[1:-1]
 
-        decl = None
-        if declinfo.startswith('class '):
-            ctx, args = self.split_context_args(name, declinfo[len('class '):])
-            decl = symbols.Class(name, ctx, args, imported=mod_imported)
-        elif declinfo.startswith('data '):
-            ctx, args = self.split_context_args(name, declinfo[len('data '):])
-            decl = symbols.Data(name, ctx, args, imported=mod_imported)
-        elif declinfo.startswith('newtype '):
-            ctx, args = self.split_context_args(name, declinfo[len('newtype '):])
-            decl = symbols.Newtype(name, ctx, args, imported=mod_imported)
-        elif declinfo.startswith('type '):
-            ctx, args = self.split_context_args(name, declinfo[len('type '):])
-            decl = symbols.Type(name, ctx, args, imported=mod_imported)
-        else:
-            # Default to function
-            decl = symbols.Function(name, declinfo, imported=mod_imported)
+        head, _, rest = declinfo.partition(' ')
+        ctor = _DECL_CTORS.get(head)
+        if ctor is not None:
+            ctx, args = self.split_context_args(name, rest)
+            return ctor(name, module, ctx, args, qualifier=qualifier)
 
-        return decl
+        # Default to function
+        return symbols.Function(name, module, declinfo, qualifier=qualifier)
 
 
     ## Unreferenced function:
@@ -605,6 +716,20 @@ class GHCModClient(object):
     ## Apologies to Ellie King. :-)
     GHCMOD_OUTPUT_MARKER = 'O: '
     GHCMOD_ERROR_MARKER = 'X: '
+    ## ... and the markers as bytes, which is how read_response sees them. 'NG ' prefixes a malformed command response;
+    ## 'OK' ends a reply.
+    GHCMOD_OUTPUT_BYTES = GHCMOD_OUTPUT_MARKER.encode('utf-8')
+    GHCMOD_ERROR_BYTES = GHCMOD_ERROR_MARKER.encode('utf-8')
+    GHCMOD_NG_BYTES = b'NG '
+    GHCMOD_OK_BYTES = b'OK'
+
+    ## Maximum number of parsed 'browse' results remembered (see cached_browse)
+    BROWSE_CACHE_SIZE = 128
+    ## Request writes up to this size go out on the pump thread; bigger ones get a writer thread (see flush_requests.)
+    ## It's the smallest pipe buffer we're likely to meet (Windows), so such a write never blocks.
+    INLINE_WRITE_SIZE = 4096
+    ## How long shutdown() gives ghc-mod to exit after the terminating blank line before killing it, in seconds
+    EXIT_TIMEOUT = 5
 
     def __init__(self, project, project_dir, opt_args):
         if debug_any():
@@ -613,8 +738,27 @@ class GHCModClient(object):
         self.ghcmod = None
         self.action_lock = None
         self.stderr_drain = None
+        # Request queue feeding the pump thread, which is the only thread that talks to ghc-mod (see pump_requests.)
+        # queue_lock makes "is the queue still open?" and put() atomic with respect to shutdown().
+        self.requests = None
+        self.queue_lock = threading.Lock()
+        # Encoded requests waiting to be written to ghc-mod in one go (see flush_requests)
+        self.req_buffer = bytearray()
         self.cmd = []
+        self.project_dir = project_dir
         self.diag_prefix = 'ghc-mod: project ' + project
+        # Idle shutdown: when ghc-mod was last used, the timer that checks for idleness, and whether ghc-mod was shut
+        # down because it was idle (in which case it is restarted on demand.) state_lock serializes start and idle
+        # shutdown.
+        self.last_used = time.monotonic()
+        self.idle_timer = None
+        self.idled_out = False
+        self.state_lock = threading.Lock()
+        # Parsed 'browse' results, module name -> symbols.Module, least recently used first. browse_last is the most
+        # recent (module name, result) pair, checked before taking browse_lock.
+        self.browse_lru = OrderedDict()
+        self.browse_last = None
+        self.browse_lock = threading.Lock()
 
         win = sublime.active_window()
         msg = 'Error and diagnostic output from ' + self.diag_prefix
@@ -643,96 +787,360 @@ class GHCModClient(object):
         if debug_any():
             print('ghc-mod command: {0}'.format(self.cmd))
 
-        self.ghcmod = ProcHelper.ProcHelper(self.cmd, cwd=project_dir)
+        self.start()
+
+    def start(self):
+        self.ghcmod = ProcHelper.ProcHelper(self.cmd, cwd=self.project_dir)
         if self.ghcmod.process is not None:
-            self.ghcmod.process.stdin = io.TextIOWrapper(self.ghcmod.process.stdin, 'utf-8')
-            self.ghcmod.process.stdout = io.TextIOWrapper(self.ghcmod.process.stdout, 'utf-8')
+            # Talk to ghc-mod over the raw (buffered) byte pipes: we encode and decode ourselves, which avoids the
+            # TextIOWrapper codec layer on every line.
             self.action_lock = threading.Lock()
             self.stderr_drain = OutputCollector.DescriptorDrain(self.diag_prefix, self.ghcmod.process.stderr)
             self.stderr_drain.start()
+            self.requests = queue.Queue()
+            pump = threading.Thread(name='pump-' + self.diag_prefix, target=self.pump_requests, args=(self.requests,))
+            pump.daemon = True
+            pump.start()
+            self.idled_out = False
+            self.last_used = time.monotonic()
+            self.schedule_idle_check(Settings.PLUGIN.ghc_mod_idle_timeout)
         else:
             Logging.log('Did not start ghc-mod ({0}) successfully.'.format(self.diag_prefix))
 
+    def ensure_running(self):
+        '''Restart ghc-mod if it was shut down for being idle.
+        '''
+        with self.state_lock:
+            self.restart_if_idled()
+
+    def restart_if_idled(self):
+        # Caller holds state_lock.
+        if self.idled_out:
+            if debug_any():
+                print('Restarting idle \'ghc-mod\' for {0}'.format(self.diag_prefix))
+            self.start()
+
+    def schedule_idle_check(self, delay):
+        if delay:
+            self.idle_timer = threading.Timer(delay, self.idle_check)
+            self.idle_timer.daemon = True
+            self.idle_timer.start()
+
+    def idle_check(self):
+        '''Idle timer callback: shut ghc-mod down if it hasn't been used for `ghc_mod_idle_timeout` seconds, otherwise
+        check again when it could next time out.
+        '''
+        idle_timeout = Settings.PLUGIN.ghc_mod_idle_timeout
+        if not idle_timeout:
+            return
+
+        with self.state_lock:
+            action_lock = self.action_lock
+            if action_lock is None:
+                # Already shut down.
+                return
+
+            remaining = idle_timeout - (time.monotonic() - self.last_used)
+            # Don't wait on a command that's in progress; it counts as activity anyway.
+            if remaining <= 0 and action_lock.acquire(False):
+                try:
+                    Logging.log('{0}: idle for {1} seconds, shutting down.'.format(self.diag_prefix, idle_timeout),
+                                Logging.LOG_INFO)
+                    self.shutdown()
+                    self.idled_out = True
+                finally:
+                    action_lock.release()
+            else:
+                self.schedule_idle_check(max(remaining, 1))
+
     def shutdown(self):
-        if self.ghcmod is not None:
+        if self.idle_timer is not None:
+            self.idle_timer.cancel()
+            self.idle_timer = None
+        with self.queue_lock:
+            if self.requests is not None:
+                # Sentinel: the pump thread exits once it gets here.
+                self.requests.put(None)
+                self.requests = None
+        ghcmod = self.ghcmod
+        if ghcmod is not None and ghcmod.process is not None:
             try:
-                print('', file=self.ghcmod.process.stdin, flush=True)
-            except OSError:
+                ghcmod.process.stdin.write(b'\n')
+                ghcmod.process.stdin.flush()
+            except (OSError, ValueError):
                 pass
+            # Reap ghc-mod, so that neither a zombie nor its pipes outlive it.
+            try:
+                ghcmod.process.wait(self.EXIT_TIMEOUT)
+            except subprocess.TimeoutExpired:
+                Logging.log('{0}: ghc-mod did not exit, killing it.'.format(self.diag_prefix), Logging.LOG_WARNING)
+                ghcmod.process.kill()
+                ghcmod.process.wait()
         if self.stderr_drain and self.stderr_drain.is_alive():
             self.stderr_drain.stop()
             self.stderr_drain.join()
+        if ghcmod is not None:
+            ghcmod.cleanup()
 
         self.ghcmod = None
         self.action_lock = None
         self.stderr_drain = None
+        self.req_buffer = bytearray()
+        # An explicit stop isn't an idle shutdown: don't restart on demand (idle_check sets this again.)
+        self.idled_out = False
+        self.invalidate_browse()
+
+    def cached_browse(self, modname):
+        '''Previously parsed 'browse' result for `modname`, or None.
+        '''
+        last = self.browse_last
+        if last is not None and last[0] == modname:
+            return last[1]
+
+        with self.browse_lock:
+            modsyms = self.browse_lru.get(modname)
+            if modsyms is not None:
+                self.browse_lru.move_to_end(modname)
+                self.browse_last = (modname, modsyms)
+            return modsyms
+
+    def cache_browse(self, modname, modsyms):
+        with self.browse_lock:
+            self.browse_lru[modname] = modsyms
+            self.browse_lru.move_to_end(modname)
+            if len(self.browse_lru) > self.BROWSE_CACHE_SIZE:
+                self.browse_lru.popitem(last=False)
+            self.browse_last = (modname, modsyms)
+
+    def invalidate_browse(self):
+        '''Forget the cached 'browse' results, e.g., because a project file's contents (may have) changed.
+        '''
+        with self.browse_lock:
+            self.browse_lru.clear()
+            self.browse_last = None
 
-    def read_response(self):
-        resp_stdout = []
+    def read_response(self, joined=False):
+        '''Read ghc-mod's reply, up to and including the terminating 'O: OK'. Returns the output lines as a list or, when
+        `joined` is True, as a single newline-separated string (which is what the regex-based callers want anyway.)
+        '''
+        resp_stdout = bytearray()
+        nlines = 0
         try:
-            got_reply = False
-            while not got_reply:
-                resp = self.ghcmod.process.stdout.readline()
-                if resp == '':
+            stdout = self.ghcmod.process.stdout
+            out_marker, err_marker, ng_marker, ok_marker = (self.GHCMOD_OUTPUT_BYTES, self.GHCMOD_ERROR_BYTES,
+                                                            self.GHCMOD_NG_BYTES, self.GHCMOD_OK_BYTES)
+            while True:
+                line = stdout.readline()
+                if not line:
                     # EOF???
-                    got_reply = True
+                    break
+
+                prefix = line[0:3]
+                body = line[3:].rstrip()
+                if prefix == out_marker:
+                    if body == ok_marker:
+                        break
+                    if nlines:
+                        resp_stdout += b'\n'
+                    resp_stdout += body
+                    nlines += 1
+                elif prefix == err_marker:
+                    # Just log the error output, just like the Emacs version
+                    self.output_panel.run_command('insert', {'characters': body.decode('utf-8', 'replace') + '\n'})
+                elif prefix == ng_marker:
+                    sys.stdout.write('{0} malformed command or error response: {1}'.format(self.diag_prefix,
+                                                                                          body.decode('utf-8', 'replace')))
+                    break
                 else:
-                    prefix = resp[0:3]
-                    resp = resp.rstrip()[3:]
-                    if prefix == self.GHCMOD_OUTPUT_MARKER:
-                        if resp == 'OK':
-                            got_reply = True
-                        else:
-                            resp_stdout.append(resp.rstrip())
-                    elif prefix == self.GHCMOD_ERROR_MARKER:
-                        # Just log the error output, just like the Emacs version
-                        self.output_panel.run_command('insert', {'characters': resp + '\n'})
-                    elif prefix == 'NG ':
-                        sys.stdout.write('{0} malformed command or error response: {1}'.format(self.diag_prefix, resp))
-                        got_reply = True
-                    else:
-                        sys.stdout.write('Unexpected reply from ghc-mod client: ' + resp)
-                        got_reply = True
-        except OSError:
+                    sys.stdout.write('Unexpected reply from ghc-mod client: ' + body.decode('utf-8', 'replace'))
+                    break
+        except (OSError, ValueError):
+            # ValueError: shutdown() closed the pipe under us.
             self.shutdown()
 
-        return resp_stdout
+        resp = resp_stdout.decode('utf-8', 'replace')
+        if joined:
+            return resp
+        return resp.split('\n') if nlines else []
 
     def command_backend(self, cmd, do_map=False, file=None, contents=None):
-        if not self.action_lock:
+        future = self.submit_batch([cmd], {file: contents} if do_map else None)
+        if future is None:
             return ([], ['No ghc-mod backend for {0}'.format(self.diag_prefix)])
 
-        with self.action_lock:
+        resps = future.result()
+        return resps[0] if resps else []
+
+    def send_map_file(self, file, contents):
+        '''Queue a 'map-file' command and the file's contents. Nothing is actually written to ghc-mod until
+        flush_requests().
+        '''
+        if debug_send():
+            print('{0}.command_backend: mapping file {1}'.format(type(self).__name__, file))
+        self.req_buffer += 'map-file {0}\n'.format(file).encode('utf-8')
+        self.req_buffer += contents.encode('utf-8')
+        self.req_buffer += b'\n\x04\n'
+
+    def send_request(self, cmd):
+        '''Queue a command. Nothing is actually written to ghc-mod until flush_requests().
+        '''
+        if debug_send():
+            print('{0}.command_backend: sending {1}'.format(type(self).__name__, cmd))
+        self.req_buffer += cmd.encode('utf-8')
+        self.req_buffer += b'\n'
+
+    def flush_requests(self):
+        '''Write all queued requests to ghc-mod with a single write and flush. Returns the writer thread when the write
+        could block, None otherwise.
+
+        ghc-mod has consumed everything written before (all of the earlier replies have been read), so a small write always
+        fits in the pipe. A bigger one can't simply block the pump, though: ghc-mod stops reading its stdin when its stdout
+        fills up answering the earlier commands in the same write, and only the pump reads ghc-mod's stdout. So the pump
+        reads the replies while a writer thread feeds ghc-mod.
+        '''
+        stdin = self.ghcmod.process.stdin
+        req_buffer = self.req_buffer
+        self.req_buffer = bytearray()
+
+        def write_requests():
             try:
-                if do_map:
-                    if debug_send():
-                        print('{0}.command_backend: mapping file {1}'.format(type(self).__name__, file))
-                    print('map-file ' + file, file=self.ghcmod.process.stdin)
-                    self.ghcmod.process.stdin.write(contents)
-                    self.ghcmod.process.stdin.write('\n' + chr(4) + '\n')
-                    self.ghcmod.process.stdin.flush()
-                    resp = self.read_response()
-                    if debug_recv():
-                        print('{0}.command_backend: map-file received {1}'.format(type(self).__name__, resp))
-                try:
-                    if debug_send():
-                        print('{0}.command_backend: sending {1}'.format(type(self).__name__, cmd))
-                    print(cmd, file=self.ghcmod.process.stdin, flush=True)
-                    resp = self.read_response()
-                    if debug_recv():
-                        print('{0}.command_backend: received {1}'.format(type(self).__name__, resp))
-                    return resp
-                except OSError:
-                    self.shutdown()
-                    return []
-                finally:
-                    if do_map:
-                        if debug_send():
-                            print('{0}.command_backend: mapping file {1}'.format(type(self).__name__, file))
-                        print('unmap-file ' + file, file=self.ghcmod.process.stdin, flush=True)
-                        unmap_resp = self.read_response()
+                stdin.write(req_buffer)
+                stdin.flush()
+            except (OSError, ValueError):
+                # ghc-mod went away (or was shut down); the pump sees EOF on stdout.
+                pass
+
+        if len(req_buffer) <= self.INLINE_WRITE_SIZE:
+            stdin.write(req_buffer)
+            stdin.flush()
+            return None
+
+        writer = threading.Thread(name='writer-' + self.diag_prefix, target=write_requests)
+        writer.daemon = True
+        writer.start()
+        return writer
+
+    def discard_replies(self, count):
+        '''Read and throw away `count` uninteresting replies, e.g., to 'map-file' and 'unmap-file'.
+        '''
+        for _ in range(count):
+            resp = self.read_response(joined=True)
+            if debug_recv():
+                print('{0}.command_backend: discarded {1}'.format(type(self).__name__, resp))
+
+    def command_batch(self, cmds, mapped=None, joined=False, on_reply=None):
+        '''Pipeline a batch of commands to ghc-mod and return their replies, in order. `mapped` is an optional
+        file -> contents dictionary of buffers mapped before and unmapped after the commands run. `joined` is passed
+        through to read_response(). `on_reply(index, reply)`, if given, is called (on the pump thread) as each reply is
+        read, so processing a reply overlaps with ghc-mod working on the following commands.
+
+        The batch is queued for the pump thread and the caller waits for the replies; callers never contend for
+        ghc-mod's pipes.
+        '''
+        future = self.submit_batch(cmds, mapped, joined, on_reply)
+        if future is None:
+            return [self.empty_reply(joined) for _ in cmds]
+
+        return future.result()
+
+    def submit_batch(self, cmds, mapped=None, joined=False, on_reply=None):
+        '''Queue a batch for the pump thread (see command_batch), restarting ghc-mod first if it idled out. Returns the
+        batch's future, or None if there's no ghc-mod to run it. The restart and the put happen under state_lock, so
+        idle_check() can't shut ghc-mod down in between.
+        '''
+        mapped = mapped or {}
+        if mapped:
+            self.invalidate_browse()
+
+        future = concurrent.futures.Future()
+        with self.state_lock:
+            self.restart_if_idled()
+            with self.queue_lock:
+                if self.requests is None:
+                    return None
+                self.last_used = time.monotonic()
+                self.requests.put((cmds, mapped, joined, on_reply, future))
+
+        return future
+
+    @staticmethod
+    def empty_reply(joined):
+        return '' if joined else []
+
+    def pump_requests(self, requests):
+        '''Request pump thread body. Takes every batch queued at the time and pipelines them all to ghc-mod with a single
+        write, then reads the replies and completes each batch's future as soon as its last reply arrives. The
+        'unmap-file' replies are read after the caller has been released.
+        '''
+        done = False
+        while not done:
+            batches = [requests.get()]
+            try:
+                while True:
+                    batches.append(requests.get_nowait())
+            except queue.Empty:
+                pass
+
+            if None in batches:
+                # shutdown() was called; nothing can be queued after the sentinel.
+                done = True
+                batches = batches[:batches.index(None)]
+
+            if batches:
+                self.execute_batches(batches)
+
+    def execute_batches(self, batches):
+        action_lock = self.action_lock
+        try:
+            if action_lock is None:
+                # Shut down while these were queued.
+                return
+
+            with action_lock:
+                for cmds, mapped, _, _, _ in batches:
+                    for file, contents in mapped.items():
+                        self.send_map_file(file, contents)
+                    for cmd in cmds:
+                        self.send_request(cmd)
+                    for file in mapped:
+                        self.send_request('unmap-file ' + file)
+                writer = self.flush_requests()
+
+                for cmds, mapped, joined, on_reply, future in batches:
+                    self.discard_replies(len(mapped))
+                    resps = []
+                    failure = None
+                    for _ in cmds:
+                        resp = self.read_response(joined)
                         if debug_recv():
-                            print('{0}.command_backend: unmap-file received {1}'.format(type(self).__name__, unmap_resp))
-            except OSError:
-                self.shutdown()
-                return []
+                            print('{0}.command_backend: received {1}'.format(type(self).__name__, resp))
+                        resps.append(resp)
+                        if on_reply is not None and failure is None:
+                            # A failing callback only fails its own batch: keep reading its replies so that we stay in
+                            # step with ghc-mod.
+                            try:
+                                on_reply(len(resps) - 1, resp)
+                            except Exception as exc:
+                                failure = exc
+                    self.last_used = time.monotonic()
+                    if failure is not None:
+                        future.set_exception(failure)
+                    else:
+                        future.set_result(resps)
+                    self.discard_replies(len(mapped))
+
+                if writer is not None:
+                    writer.join()
+        except (OSError, AttributeError):
+            # AttributeError: read_response() shut us down mid-batch.
+            self.shutdown()
+        except Exception:
+            # Something unexpected went wrong reading the replies. They may now be out of step with the requests, so
+            # there's no way to carry on with this ghc-mod.
+            Logging.log('{0}: request failed, see console window traceback'.format(self.diag_prefix), Logging.LOG_ERROR)
+            traceback.print_exc()
+            self.shutdown()
+        finally:
+            for cmds, _, joined, _, future in batches:
+                if not future.done():
+                    future.set_result([self.empty_reply(joined) for _ in cmds])
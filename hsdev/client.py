@@ -16,6 +16,13 @@ import SublimeHaskell.internals.logging as Logging
 import SublimeHaskell.internals.settings as Settings
 import SublimeHaskell.internals.utils as Utils
 
+try:
+    # Faster decoding for hsdev's (possibly large) responses, when it's installed where Sublime's Python can find it.
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
 def debug_send():
     return Settings.COMPONENT_DEBUG.all_messages or Settings.COMPONENT_DEBUG.send_messages
 
@@ -54,7 +61,7 @@ class HsDevConnection(object):
             pre, sep, post = self.read_decoded_req().partition('\n')
             pre = ''.join([req_remain, pre])
             while sep:
-                resp = json.loads(pre)
+                resp = json_loads(pre)
                 self.client.dispatch_response(resp)
                 (pre, sep, post) = post.partition('\n')
             req_remain = pre
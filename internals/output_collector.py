@@ -27,6 +27,10 @@ class OutputCollector(object):
         panel.set_read_only(False)
 
         if self.prochelp.process is not None:
+            # Nothing is ever written to the process' stdin: close it now, so that a tool that reads it sees EOF right away
+            # instead of waiting for us.
+            self.prochelp.process.stdin.close()
+
             lines_lock = threading.RLock()
             self.stdout_collector = FileObjectCollector("stdout-collector", panel, lines_lock,
                                                         self.lines, self.prochelp.process.stdout)
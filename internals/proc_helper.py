@@ -6,6 +6,14 @@ import errno
 import subprocess
 import os
 import os.path
+import sys
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    # Windows.
+    fcntl = None
 
 import SublimeHaskell.sublime_haskell_common as Common
 import SublimeHaskell.internals.logging as Logging
@@ -15,39 +23,69 @@ import SublimeHaskell.internals.which as Which
 import SublimeHaskell.internals.cabal_cfgrdr as CabalConfigRdr
 import SublimeHaskell.internals.cabal_reader as CabalReader
 
+# The platform doesn't change under our feet: only ask once.
+IS_WINDOWS = Utils.is_windows()
+
+def make_startupinfo():
+    '''Windows: keep the subprocesses' console windows hidden.'''
+    startupinfo = subprocess.STARTUPINFO()
+    startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
+    return startupinfo
+
+# Python 3.7+ copies startupinfo before filling in the standard handles, so one instance is shared by every spawn. Older
+# Pythons write the handles into the caller's object: threads spawning at the same time would clobber each other's, so
+# those still get a new one per spawn.
+STARTUPINFO = make_startupinfo() if IS_WINDOWS and sys.version_info >= (3, 7) else None
+
+# Linux's F_SETPIPE_SZ: the fcntl module only names it from Python 3.10 onward.
+F_SETPIPE_SZ = getattr(fcntl, 'F_SETPIPE_SZ', 1031)
+# Pipe buffer size for bulk subprocess output (1 MiB, see ProcHelper.grow_stdout.) The default 64 KiB buffer
+# makes tools with bulk output block every time it fills up.
+PIPE_SIZE = 1 << 20
+
 class ProcHelper(object):
     """Command and tool process execution helper."""
 
     # Augmented PATH for the subprocesses and locating executables.
     augmented_path = None
+    # The settings augmented_path was built from (see augmented_path_key.)
+    augmented_path_settings = None
+    # (augmented_path, inherited PATH, split search path): see search_path().
+    search_path_cache = (None, None, [])
 
     def __init__(self, command, **popen_kwargs):
         """Open a pipe to a command or tool."""
 
-        if ProcHelper.augmented_path is None:
-            ProcHelper.augmented_path = ProcHelper.make_augmented_path()
+        # update_environment() can reset ProcHelper.augmented_path from another thread at any time: use the one value
+        # for both the executable lookup and the subprocess' PATH.
+        aug_path, search_path = ProcHelper.augmented_search_path()
 
         ## Necessary evil: Don't cache the environment, just update the PATH in the current environment.
         ## Why? Because someone could (like me) change os.environ via the ST console and those changes
         ## would never make it here. Use case: settting $http_proxy so that stack can fetch packages.
-        proc_env = dict(os.environ)
-        proc_env['PATH'] = ProcHelper.augmented_path + os.pathsep + proc_env.get('PATH', '')
+        ##
+        ## When there's nothing to add to the PATH, the subprocess simply inherits the environment (env=None) and the copy is
+        ## skipped altogether.
+        proc_env = None
+        if aug_path:
+            proc_env = os.environ.copy()
+            proc_env['PATH'] = aug_path + os.pathsep + proc_env.get('PATH', '')
 
         self.process = None
         self.process_err = None
 
-        if Utils.is_windows():
-            startupinfo = subprocess.STARTUPINFO()
-            startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
-            popen_kwargs['startupinfo'] = startupinfo
+        if IS_WINDOWS:
+            popen_kwargs['startupinfo'] = STARTUPINFO or make_startupinfo()
 
         # Allow caller to specify something different for stdout or stderr -- provide
         # the default here if unspecified.
         popen_kwargs.setdefault('stdout', subprocess.PIPE)
         popen_kwargs.setdefault('stderr', subprocess.PIPE)
+        # Buffered pipes: Python 3.3.0's default is unbuffered, i.e., a system call per read.
+        popen_kwargs.setdefault('bufsize', -1)
 
         try:
-            normcmd = Which.which(command, proc_env['PATH'])
+            normcmd = Which.which_from_list(command, search_path)
             if normcmd is not None:
                 self.process = subprocess.Popen(normcmd, stdin=subprocess.PIPE, env=proc_env, **popen_kwargs)
             else:
@@ -78,6 +116,18 @@ class ProcHelper(object):
                 self.process = None
                 raise os_exc
 
+    def grow_stdout(self):
+        '''Enlarge the subprocess' stdout pipe, if the platform lets us (Linux only.) Only for the bulk-output reader,
+        wait(): the buffer counts against the user's pipe-user-pages-soft limit, so long-lived processes and stderr pipes
+        keep the default. Best effort: the kernel can refuse (e.g., /proc/sys/fs/pipe-max-size), in which case the
+        default size stays.
+        '''
+        if fcntl is not None and sys.platform.startswith('linux') and self.process.stdout is not None:
+            try:
+                fcntl.fcntl(self.process.stdout.fileno(), F_SETPIPE_SZ, PIPE_SIZE)
+            except OSError:
+                pass
+
     # 'with' statement support:
     def __enter__(self):
         return self
@@ -98,7 +148,8 @@ class ProcHelper(object):
         """Wait for subprocess to complete and exit, collect and decode ``stdout`` and ``stderr``,
         returning the tuple ``(exit_code, stdout, stderr)```"""
         if self.process is not None:
-            stdout, stderr = self.process.communicate(Utils.encode_bytes(input_str or ''))
+            self.grow_stdout()
+            stdout, stderr = self.process.communicate(ProcHelper.stdin_payload(input_str))
             exit_code = self.process.wait()
             # Ensure that we reap the file descriptors.
             self.cleanup()
@@ -106,27 +157,58 @@ class ProcHelper(object):
 
         return (-1, '', self.process_err or "?? unknown error -- no process.")
 
+    @staticmethod
+    def stdin_payload(input_str):
+        '''What to write to the subprocess' stdin: None when there's no input (communicate() then just closes stdin),
+        bytes as they are, and text encoded via Utils.encode_bytes().'''
+        if not input_str:
+            return None
+        if isinstance(input_str, (bytes, bytearray)):
+            return input_str
+        return Utils.encode_bytes(input_str)
+
     # Update the augmented environment when `add_to_PATH` or `add_standard_dirs` change.
     @staticmethod
     def update_environment(_key, _val):
-        # Reinitialize the tool -> path cache:
+        # Reinitialize the tool -> path cache, whatever changed: it's cheap to refill, and a setting change is when users
+        # expect newly installed tools to be picked up.
         Which.reset_cache()
-        ProcHelper.augmented_path = ProcHelper.make_augmented_path()
+
+        # Settings callbacks also fire when a value is changed and then changed back, or the settings are reloaded: skip
+        # the directory stats and cabal config parsing if the PATH-related settings are the same as last time.
+        if ProcHelper.augmented_path is not None and \
+           ProcHelper.augmented_path_settings == ProcHelper.augmented_path_key():
+            return
+
+        # Drop the augmented PATH: it's rebuilt when the next subprocess needs it, so a burst of setting changes (e.g.,
+        # while the plugin loads) only costs one rebuild.
+        ProcHelper.augmented_path = None
+
+    @staticmethod
+    def augmented_path_key():
+        '''The settings that make_augmented_path() depends on, as a hashable value.'''
+        return (tuple(Settings.PLUGIN.add_to_path), bool(Settings.PLUGIN.add_standard_dirs))
 
     @staticmethod
     def make_augmented_path():
         ''' Generate the augmented PATH for subprocesses: adds the appropriate cabal/stack local install directory
         ($HOME/.local/bin for *nix, %APPDATA%/local/bin for Windows) and updates PATH with `add_to_PATH` extras.
         '''
+        ProcHelper.augmented_path_settings = ProcHelper.augmented_path_key()
+
         std_places = []
         if Settings.PLUGIN.add_standard_dirs:
-            std_places.append("$HOME/.local/bin" if not Utils.is_windows() else "%APPDATA%/local/bin")
+            std_places.append("$HOME/.local/bin" if not IS_WINDOWS else "%APPDATA%/local/bin")
             if Utils.is_macosx():
                 std_places.append('$HOME/Library/Haskell/bin')
             std_places += CabalConfigRdr.cabal_config()
-            std_places = [dir for dir in [Utils.normalize_path(path) for path in std_places] if os.path.isdir(dir)]
+            std_places = [Utils.normalize_path(path) for path in std_places]
+
+        add_to_path = list(map(Utils.normalize_path, Settings.PLUGIN.add_to_path))
 
-        add_to_path = list(filter(os.path.isdir, map(Utils.normalize_path, Settings.PLUGIN.add_to_path)))
+        existing = existing_dirs(add_to_path + std_places)
+        std_places = [dir for dir in std_places if dir in existing]
+        add_to_path = [dir for dir in add_to_path if dir in existing]
 
         Logging.log("std_places = {0}".format(std_places), Logging.LOG_INFO)
         Logging.log("add_to_PATH = {0}".format(add_to_path), Logging.LOG_INFO)
@@ -134,10 +216,33 @@ class ProcHelper(object):
         return os.pathsep.join(add_to_path + std_places)
 
     @staticmethod
-    def get_extended_path():
-        if ProcHelper.augmented_path is None:
-            ProcHelper.augmented_path = ProcHelper.make_augmented_path()
-        return ProcHelper.augmented_path + os.pathsep + (os.environ.get('PATH', ''))
+    def current_augmented_path():
+        '''The augmented PATH, (re)building it if update_environment() dropped it. The class attribute is read only once:
+        another thread can reset it to None at any time.
+        '''
+        aug_path = ProcHelper.augmented_path
+        if aug_path is None:
+            aug_path = ProcHelper.make_augmented_path()
+            ProcHelper.augmented_path = aug_path
+        return aug_path
+
+    @staticmethod
+    def search_path():
+        '''The augmented PATH followed by the inherited PATH, as a list of directories, for Which.which_from_list().
+        '''
+        return ProcHelper.augmented_search_path()[1]
+
+    @staticmethod
+    def augmented_search_path():
+        '''The augmented PATH and the search path list (see search_path()) built from it, as a pair. The list is only
+        re-split when the augmented path or the inherited PATH changes.
+        '''
+        aug_path, env_path = ProcHelper.current_augmented_path(), os.environ.get('PATH', '')
+        cached_aug, cached_env, path_list = ProcHelper.search_path_cache
+        if cached_aug is not aug_path or cached_env != env_path:
+            path_list = ((aug_path + os.pathsep if aug_path else '') + env_path).split(os.pathsep)
+            ProcHelper.search_path_cache = (aug_path, env_path, path_list)
+        return (aug_path, path_list)
 
     @staticmethod
     def run_process(command, input_string='', **popen_kwargs):
@@ -146,6 +251,30 @@ class ProcHelper(object):
             return proc.wait(input_string)
 
 
+def existing_dirs(candidates):
+    '''The subset of the directory paths in `candidates` that actually exist, as a set. Candidates that share a parent
+    directory are checked with a single os.scandir() of the parent instead of a stat() apiece.
+    '''
+    by_parent = {}
+    for cand in candidates:
+        by_parent.setdefault(os.path.dirname(cand), set()).add(cand)
+
+    existing = set()
+    for parent, members in by_parent.items():
+        if len(members) > 1 and hasattr(os, 'scandir'):
+            # os.scandir() is Python 3.5+; Sublime Text 3's Python 3.3 takes the stat() path.
+            try:
+                subdirs = set(os.path.normcase(os.path.join(parent, entry.name))
+                              for entry in os.scandir(parent) if entry.is_dir())
+                existing.update(dir for dir in members if os.path.normcase(dir) in subdirs)
+                continue
+            except OSError:
+                pass
+        existing.update(filter(os.path.isdir, members))
+
+    return existing
+
+
 def exec_wrapper_cmd(exec_with, cmd_list):
     wrapper = []
     if exec_with == 'cabal':
@@ -174,7 +303,7 @@ def exec_with_wrapper(exec_with, install_dir, cmd_list):
         else:
             raise RuntimeError('ProcHelper.exec_with_wrapper: invalid install_dir (None)')
     else:
-        cmd = Which.which(cmd_list[0], ProcHelper.get_extended_path())
+        cmd = Which.which_from_list(cmd_list[0], ProcHelper.search_path())
         if cmd is not None:
             cmd_list[0] = cmd
 
@@ -182,35 +311,81 @@ def exec_with_wrapper(exec_with, install_dir, cmd_list):
     return ProcHelper(cmd_list, **proc_args)
 
 
+# Directory -> (cabal_dir, cabal_proj) for directories known to be inside a cabal project. Saves walking up the
+# directory tree looking for the .cabal file for every file in the same directory.
+CABAL_PROJECT_CACHE = {}
+
+# .cabal file -> (modification time, source roots) for get_source_dir().
+SOURCE_DIRS_CACHE = {}
+SOURCE_DIRS_LOCK = threading.Lock()
+
+def source_dirs_for(cabal_dir, cabal_proj):
+    '''The absolute hs-source-dirs roots for a cabal project, as a dictionary keyed by the normalized (os.path.normcase)
+    root, so that a file's enclosing root can be found with one lookup per directory level.
+    '''
+    proj_info = CabalReader.CabalProjectReader(cabal_dir, cabal_proj)
+    cabal_info = proj_info.cabal_info
+    dirs = ['.']
+
+    executables = cabal_info.get('executable', {})
+    dirs.extend([sdir.strip()
+                 for exe in executables
+                 for sdirs in executables[exe].get('hs-source-dirs', [])
+                 for sdir in sdirs.split(',')])
+    dirs.extend([sdir.strip()
+                 for sdirs in cabal_info.get('library', {}).get('hs-source-dirs', [])
+                 for sdir in sdirs.split(',')])
+
+    paths = [os.path.abspath(os.path.join(cabal_dir, srcdirs)) for srcdirs in set(dirs)]
+    return dict((os.path.normcase(path), path) for path in paths)
+
+
+def cached_source_dirs(cabal_dir, cabal_proj, cabal_mtime):
+    '''The source roots for a cabal project, reading the .cabal file again only when it has changed since.
+    '''
+    cabal_file = os.path.join(cabal_dir, cabal_proj + '.cabal')
+    with SOURCE_DIRS_LOCK:
+        cached = SOURCE_DIRS_CACHE.get(cabal_file)
+    if cached is not None and cached[0] == cabal_mtime:
+        return cached[1]
+
+    # Never answer with stale roots: the result ends up in a ghc-mod command line ('-i') for that client's lifetime.
+    roots = source_dirs_for(cabal_dir, cabal_proj)
+    with SOURCE_DIRS_LOCK:
+        SOURCE_DIRS_CACHE[cabal_file] = (cabal_mtime, roots)
+    return roots
+
+
 def get_source_dir(filename):
     '''Get root of hs-source-dirs for filename in project.
     '''
     if not filename:
         return os.path.expanduser('~')
 
-    cabal_dir, cabal_proj = Common.locate_cabal_project(filename)
+    file_dir = os.path.dirname(filename)
+    cabal_dir, cabal_proj = CABAL_PROJECT_CACHE.get(file_dir) or Common.locate_cabal_project(filename)
     if not cabal_dir:
         # No cabal file -> Punt and assume the source directory for the file and project is the same as the file.
-        return os.path.dirname(filename)
+        return file_dir
     else:
-        proj_info = CabalReader.CabalProjectReader(cabal_dir, cabal_proj)
-        cabal_info = proj_info.cabal_info
-        dirs = ['.']
-
-        executables = cabal_info.get('executable', {})
-        dirs.extend([sdir.strip()
-                     for exe in executables
-                     for sdirs in executables[exe].get('hs-source-dirs', [])
-                     for sdir in sdirs.split(',')])
-        dirs.extend([sdir.strip()
-                     for sdirs in cabal_info.get('library', {}).get('hs-source-dirs', [])
-                     for sdir in sdirs.split(',')])
-
-        paths = [os.path.abspath(os.path.join(cabal_dir, srcdirs)) for srcdirs in set(dirs)]
-        paths.sort(key=lambda p: -len(p))
-
-        for path in paths:
-            if filename.startswith(path):
+        try:
+            cabal_mtime = os.stat(os.path.join(cabal_dir, cabal_proj + '.cabal')).st_mtime
+        except OSError:
+            # The .cabal file went away: forget it and let the next call look for it again.
+            CABAL_PROJECT_CACHE.pop(file_dir, None)
+            return file_dir
+
+        CABAL_PROJECT_CACHE[file_dir] = (cabal_dir, cabal_proj)
+        # Walk up from the file's directory: the first source root we hit is the innermost one.
+        roots = cached_source_dirs(cabal_dir, cabal_proj, cabal_mtime)
+        src_dir = os.path.normcase(os.path.abspath(file_dir))
+        while True:
+            path = roots.get(src_dir)
+            if path is not None:
                 return path
+            parent = os.path.dirname(src_dir)
+            if parent == src_dir:
+                break
+            src_dir = parent
 
-    return os.path.dirname(filename)
+    return file_dir
@@ -49,6 +49,7 @@ class SettingsContainer(object):
         same_property_pref('enable_auto_check'),
         same_property_pref('enable_auto_lint'),
         same_property_pref('enable_hdocs'),
+        same_property_pref('ghc_mod_idle_timeout'),
         same_property_pref('ghc_opts'),
         same_property_pref('ghci_opts'),
         same_property_pref('haskell_build_tool'),
@@ -90,6 +91,7 @@ class SettingsContainer(object):
         self._enable_auto_lint = True
         self._enable_infer_types = True
         self._enable_hdocs = False
+        self._ghc_mod_idle_timeout = 300
         self._ghc_opts = []
         self._ghci_opts = []
         self._haskell_build_tool = 'stack'
@@ -139,6 +141,7 @@ class SettingsContainer(object):
     enable_auto_lint = make_config_property('enable_auto_lint')
     enable_infer_types = make_config_property('enable_infer_types')
     enable_hdocs = make_config_property('enable_hdocs')
+    ghc_mod_idle_timeout = make_config_property('ghc_mod_idle_timeout')
     ghc_opts = make_config_property('ghc_opts')
     ghci_opts = make_config_property('ghci_opts')
     haskell_build_tool = make_config_property('haskell_build_tool')
@@ -1,5 +1,6 @@
 import os
 import os.path
+import time
 
 import SublimeHaskell.internals.atomics as Atomics
 import SublimeHaskell.internals.utils as Utils
@@ -9,8 +10,17 @@ def is_exe(fpath):
 
 # Tool name -> executable path cache. Avoids probing the file system multiple times.
 WHICH_CACHE = Atomics.AtomicDuck()
+# Tools that weren't found -> (the search path they weren't found on, when the miss expires.) Looking for them again on
+# the same path doesn't rescan it for MISS_LIFETIME seconds; a different path (e.g., PATH was changed via os.environ), or
+# a later lookup (e.g., the tool was just installed into a directory already on the PATH), gets searched.
+WHICH_MISSES = Atomics.AtomicDuck()
+MISS_LIFETIME = 10.0
+# Executable suffixes to try when looking for a tool.
+EXE_EXTS = [''] if not Utils.is_windows() else ['.exe', '.cmd', '.bat']
 
-def which(cmd, env_path):
+def which_from_list(cmd, path_list):
+    '''Locate `cmd` (a command name, or a command line as a list) on the search path `path_list`, a list of directories.
+    Returns the command with its executable's full path, or None if it wasn't found.'''
     cmd_is_list = isinstance(cmd, list)
     the_cmd = cmd[0] if cmd_is_list else cmd
     cmd_args = cmd[1:] if cmd_is_list else []
@@ -20,29 +30,35 @@ def which(cmd, env_path):
 
     with WHICH_CACHE as cache:
         cval = cache.get(the_cmd)
+    with WHICH_MISSES as misses:
+        miss = misses.get(the_cmd)
 
-    if cval is not None:
+    if cval is None and miss is not None and miss[0] == path_list and time.monotonic() < miss[1]:
+        return None
+    elif cval is not None:
         return [cval] + cmd_args if cmd_is_list else cval
     else:
-        exe_exts = [''] if not Utils.is_windows() else ['.exe', '.cmd', '.bat']
-
         program = the_cmd
         fpath, _ = os.path.split(program)
         if fpath:
             if is_exe(program):
                 return cmd
         else:
-            for path in env_path.split(os.pathsep):
+            for path in path_list:
                 path = path.strip('"')
-                for ext in exe_exts:
+                for ext in EXE_EXTS:
                     exe_file = os.path.join(path, program)
                     if is_exe(exe_file + ext):
                         with WHICH_CACHE as cache:
                             cache[program] = exe_file
                         return [exe_file] + cmd_args if cmd_is_list else exe_file
 
+            with WHICH_MISSES as misses:
+                misses[program] = (path_list, time.monotonic() + MISS_LIFETIME)
+
     return None
 
 def reset_cache():
-    global WHICH_CACHE
+    global WHICH_CACHE, WHICH_MISSES
     WHICH_CACHE = Atomics.AtomicDuck()
+    WHICH_MISSES = Atomics.AtomicDuck()